@@ -90,13 +90,19 @@ def learn_d_z_weighted(
     n_trials, n_times = check_dimension(X, expected_shape='n_trials, n_times')
 
     if init_tau:
-        phi = np.tile(np.var(X, axis=1)[:, None], X.shape[1])
-        tau = 1 / phi
+        # phi is modified inplace by estimate_phi_mh, so it needs its own
+        # full-size array.
+        phi = np.broadcast_to(np.var(X, axis=1)[:, None], X.shape).copy()
+        tau = np.reciprocal(phi)
     else:
         # assume gaussian to start with
         phi = np.full(shape=(n_trials, n_times), fill_value=2.0)
         tau = np.full(shape=(n_trials, n_times), fill_value=0.5)
 
+    # learn_d_z does not modify sample_weights, so the buffer can be reused
+    # across the global iterations.
+    sample_weights = np.empty_like(tau)
+
     rng = check_random_state(random_state)
     d_hat = ds_init
     z_hat = None
@@ -117,10 +123,12 @@ def learn_d_z_weighted(
             return_loglk=True, verbose=verbose)
 
         # M-step: Optimize d and z wrt the new weights
+        np.multiply(tau, 2, out=sample_weights)
         pobj, times, d_hat, z_hat, reg = learn_d_z(
             X, n_atoms, n_times_atom, func_d, reg=reg, lmbd_max=lmbd_max,
-            n_iter=n_iter_optim, random_state=rng, sample_weights=2 * tau,
-            ds_init=d_hat, ds_init_params=ds_init_params,
+            n_iter=n_iter_optim, random_state=rng,
+            sample_weights=sample_weights, ds_init=d_hat,
+            ds_init_params=ds_init_params,
             solver_d_kwargs=solver_d_kwargs, solver_z_kwargs=solver_z_kwargs,
             verbose=verbose, solver_z=solver_z, n_jobs=n_jobs,
             callback=callback)
@@ -5,6 +5,7 @@ from scipy.optimize import approx_fprime
 
 
 from alphacsc.utils import get_D
+from alphacsc.utils import check_random_state
 from alphacsc.utils import construct_X_multi
 from alphacsc.utils.whitening import whitening
 from alphacsc.loss_and_gradient import gradient_d
@@ -69,56 +70,61 @@ def gradient_checker(func, grad, shape, args=(), kwargs={}, n_checks=10,
         test_grad(z0)
 
 
-@pytest.mark.parametrize('loss', ['l2', 'dtw', 'whitening'])
-@pytest.mark.parametrize('func', [
-    _construct_X, _gradient_zi, _objective, _gradient_d])
-def test_consistency(loss, func):
-    """Check that the result are the same for the full rank D and rank 1 uv.
-    """
-    n_trials, n_channels, n_times = 5, 3, 30
-    n_atoms, n_times_atom = 4, 7
-
+def _make_problem(loss, n_trials, n_channels, n_times, n_atoms,
+                  n_times_atom):
+    """Generate random signals, activations and atoms for a given loss."""
     loss_params = dict(gamma=.01)
 
     n_times_valid = n_times - n_times_atom + 1
 
-    X = np.random.randn(n_trials, n_channels, n_times)
-    z = np.random.randn(n_trials, n_atoms, n_times_valid)
+    rng = check_random_state(42)
+    X = rng.randn(n_trials, n_channels, n_times)
+    z = rng.randn(n_trials, n_atoms, n_times_valid)
 
-    uv = np.random.randn(n_atoms, n_channels + n_times_atom)
+    uv = rng.randn(n_atoms, n_channels + n_times_atom)
     D = get_D(uv, n_channels)
 
     if loss == "whitening":
         loss_params['ar_model'], X = whitening(X)
 
+    return loss, X, z, uv, D, loss_params
+
+
+@pytest.fixture(scope='module', params=['l2', 'dtw', 'whitening'])
+def consistency_problem(request):
+    return _make_problem(request.param, n_trials=5, n_channels=3, n_times=30,
+                         n_atoms=4, n_times_atom=7)
+
+
+@pytest.fixture(scope='module', params=['l2', 'dtw', 'whitening'])
+def gradients_problem(request):
+    return _make_problem(request.param, n_trials=5, n_channels=3,
+                         n_times=100, n_atoms=10, n_times_atom=15)
+
+
+@pytest.mark.parametrize('func', [
+    _construct_X, _gradient_zi, _objective, _gradient_d])
+def test_consistency(consistency_problem, func):
+    """Check that the result are the same for the full rank D and rank 1 uv.
+    """
+    loss, X, z, uv, D, loss_params = consistency_problem
+
     val_D = func(X, z, D, loss, loss_params=loss_params)
     val_uv = func(X, z, uv, loss, loss_params=loss_params)
     assert np.allclose(val_D, val_uv)
 
 
-@pytest.mark.parametrize('loss', ['l2', 'dtw', 'whitening'])
-def test_gradients(loss):
+def test_gradients(gradients_problem):
     """Check that the gradients have the correct shape.
     """
-    n_trials, n_channels, n_times = 5, 3, 100
-    n_atoms, n_times_atom = 10, 15
+    loss, X, z, uv, D, loss_params = gradients_problem
+    n_atoms, n_channels, _ = D.shape
+    n_times_valid = z.shape[2]
 
     n_checks = 5
     if loss == "dtw":
         n_checks = 1
 
-    loss_params = dict(gamma=.01)
-
-    n_times_valid = n_times - n_times_atom + 1
-
-    X = np.random.randn(n_trials, n_channels, n_times)
-    z = np.random.randn(n_trials, n_atoms, n_times_valid)
-
-    uv = np.random.randn(n_atoms, n_channels + n_times_atom)
-    D = get_D(uv, n_channels)
-    if loss == "whitening":
-        loss_params['ar_model'], X = whitening(X)
-
     # Test gradient D
     assert D.shape == _gradient_d(X, z, D, loss, loss_params=loss_params).shape
 
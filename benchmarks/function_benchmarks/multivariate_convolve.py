@@ -1,11 +1,13 @@
 import time
+import functools
 
 import numba
 import numpy as np
 import pandas as pd
-from joblib import Memory
+from joblib import Memory, Parallel, delayed, effective_n_jobs
 import matplotlib.pyplot as plt
-from scipy.signal import fftconvolve
+from scipy.fft import rfft, irfft, next_fast_len
+from numpy.lib.stride_tricks import as_strided
 from scipy.stats.mstats import gmean
 
 memory = Memory(location='', verbose=0)
@@ -17,14 +19,26 @@ def scipy_fftconvolve(ztz, D):
     D.shape = n_atoms, n_channels, n_times_atom
     """
     n_atoms, n_channels, n_times_atom = D.shape
-    # TODO: try with zero padding to next_fast_len
+    n_fft = next_fast_len(3 * n_times_atom - 2)
 
-    G = np.zeros(D.shape)
-    for k0 in range(n_atoms):
-        for k1 in range(n_atoms):
-            for p in range(n_channels):
-                G[k0, p] += fftconvolve(ztz[k0, k1], D[k1, p], mode='valid')
-    return G
+    # transform each signal once, and sum the products over k1 in Fourier
+    ztz_fft = rfft(ztz, n=n_fft, axis=-1)
+    D_fft = rfft(D, n=n_fft, axis=-1)
+    G_fft = np.einsum('kKf,Kpf->kpf', ztz_fft, D_fft)
+    G = irfft(G_fft, n=n_fft, axis=-1)
+    return G[:, :, n_times_atom - 1:2 * n_times_atom - 1]
+
+
+def _ztz_windows(ztz, n_times_atom):
+    """Strided view of ztz with windows[k0, k1, t, u] = ztz[k0, k1, t + u]
+
+    ztz.shape = n_atoms, n_atoms, 2 * n_times_atom - 1
+    windows.shape = n_atoms, n_atoms, n_times_atom, n_times_atom
+    """
+    s0, s1, s2 = ztz.strides
+    shape = ztz.shape[:2] + (n_times_atom, n_times_atom)
+    return as_strided(ztz, shape=shape, strides=(s0, s1, s2, s2),
+                      writeable=False)
 
 
 def numpy_convolve(ztz, D):
@@ -33,62 +47,69 @@ def numpy_convolve(ztz, D):
     D.shape = n_atoms, n_channels, n_times_atom
     """
     n_atoms, n_channels, n_times_atom = D.shape
+    ztz_windows = _ztz_windows(ztz, n_times_atom)
+    return np.einsum('kKtu,Kpu->kpt', ztz_windows, D[:, :, ::-1],
+                     optimize=True)
 
-    G = np.zeros(D.shape)
-    for k0 in range(n_atoms):
-        for k1 in range(n_atoms):
-            for p in range(n_channels):
-                G[k0, p] += np.convolve(ztz[k0, k1], D[k1, p], mode='valid')
-    return G
+
+@numba.njit('void(f8[:, :, ::1], f8[:, :, ::1], f8[:, :, ::1])',
+            parallel=True, fastmath=True, cache=True)
+def _dot_and_numba(ztz, D_revert, G):
+    n_atoms, n_channels, n_times_atom = D_revert.shape
+    for k0 in numba.prange(n_atoms):
+        for p in range(n_channels):
+            for t in range(n_times_atom):
+                s = 0.0
+                for k1 in range(n_atoms):
+                    for u in range(n_times_atom):
+                        s += ztz[k0, k1, t + u] * D_revert[k1, p, u]
+                G[k0, p, t] = s
 
 
-@numba.jit(nogil=True)
 def dot_and_numba(ztz, D):
     """
     ztz.shape = n_atoms, n_atoms, 2 * n_times_atom - 1
     D.shape = n_atoms, n_channels, n_times_atom
     """
-    n_atoms, n_channels, n_times_atom = D.shape
-    G = np.zeros(D.shape)
-    for k0 in range(n_atoms):
-        for k1 in range(n_atoms):
-            for p in range(n_channels):
-                for t in range(n_times_atom):
-                    G[k0, p, t] += np.dot(ztz[k0, k1, t:t + n_times_atom],
-                                          D[k1, p, ::-1])
+    G = np.empty(D.shape)
+    _dot_and_numba(np.ascontiguousarray(ztz),
+                   np.ascontiguousarray(D[:, :, ::-1]), G)
     return G
 
 
-@numba.jit(nogil=True)
-def sum_and_numba(ztz, D):
+def tensordot(ztz, D):
     """
     ztz.shape = n_atoms, n_atoms, 2 * n_times_atom - 1
     D.shape = n_atoms, n_channels, n_times_atom
     """
     n_atoms, n_channels, n_times_atom = D.shape
+    n_atoms_out = ztz.shape[0]
+    n_rows = n_atoms * n_times_atom
+    ztz_windows = _ztz_windows(ztz, n_times_atom)
+    ztz_windows = ztz_windows.transpose(0, 2, 1, 3).reshape(-1, n_rows)
+    D = D[:, :, ::-1].transpose(0, 2, 1).reshape(n_rows, n_channels)
 
-    G = np.zeros(D.shape)
-    for k0 in range(n_atoms):
-        for p in range(n_channels):
-            for t in range(n_times_atom):
-                G[k0, p, t] += np.sum(
-                    ztz[k0, :, t:t + n_times_atom] * D[:, p, ::-1])
-    return G
+    G = np.dot(ztz_windows, D)
+    return G.reshape(n_atoms_out, n_times_atom, n_channels).transpose(0, 2, 1)
 
 
-def tensordot(ztz, D):
-    """
+def convolve_ztz_d(ztz, D):
+    """Choose between numpy_convolve and scipy_fftconvolve depending on the
+    size of the atoms, and perform the convolution.
+
     ztz.shape = n_atoms, n_atoms, 2 * n_times_atom - 1
     D.shape = n_atoms, n_channels, n_times_atom
     """
     n_atoms, n_channels, n_times_atom = D.shape
-    D = D[:, :, ::-1]
-
-    G = np.zeros(D.shape)
-    for t in range(n_times_atom):
-        G[:, :, t] = np.tensordot(ztz[:, :, t:t + n_times_atom], D,
-                                  axes=([1, 2], [0, 2]))
-    return G
+    # With 16 atoms, this benchmark measured the crossover between the two
+    # kernels at n_times_atom ~ 40 for 5 channels and ~ 96 for 160 channels,
+    # as the GEMM of numpy_convolve gets more efficient with more channels.
+    # Interpolate it as a power law of n_channels.
+    n_times_atom_crossover = 40 * (n_channels / 5) ** 0.25
+    if n_times_atom < n_times_atom_crossover:
+        return numpy_convolve(ztz, D)
+    else:
+        return scipy_fftconvolve(ztz, D)
 
 
 def numpy_convolve_uv(ztz, uv):
@@ -98,27 +119,76 @@ def numpy_convolve_uv(ztz, uv):
     """
     assert uv.ndim == 2
     n_times_atom = (ztz.shape[2] + 1) // 2
-    n_atoms = ztz.shape[0]
     n_channels = uv.shape[1] - n_times_atom
 
     u = uv[:, :n_channels]
     v = uv[:, n_channels:]
 
-    G = np.zeros((n_atoms, n_channels, n_times_atom))
-    for k0 in range(n_atoms):
-        for k1 in range(n_atoms):
-            G[k0, :, :] += (np.convolve(
-                ztz[k0, k1], v[k1], mode='valid')[None, :] * u[k1, :][:, None])
+    # valid convolutions of ztz[k0, k1] with v[k1], then combination with u
+    ztz_windows = _ztz_windows(ztz, n_times_atom)
+    ztz_v = np.matmul(ztz_windows, v[None, :, ::-1, None])[..., 0]
+    G = np.tensordot(ztz_v, u, axes=([1], [0]))
+    return G.transpose(0, 2, 1)
 
-    return G
+
+def _parallel_over_atoms(func, ztz, D, n_jobs=-1):
+    """Split the computation of func(ztz, D) over chunks of the first atom
+    axis, as each row G[k0] only depends on ztz[k0].
+    """
+    n_atoms = D.shape[0]
+    n_jobs = min(effective_n_jobs(n_jobs), n_atoms)
+    if n_atoms < 4 or n_jobs == 1:
+        return func(ztz, D)
+
+    # numpy, scipy.fft and BLAS release the GIL, so threads are enough
+    chunks = np.array_split(np.arange(n_atoms), n_jobs)
+    Gs = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(func)(ztz[chunk], D) for chunk in chunks)
+    return np.concatenate(Gs)
+
+
+def numpy_convolve_parallel(ztz, D):
+    return _parallel_over_atoms(numpy_convolve, ztz, D)
+
+
+def scipy_fftconvolve_parallel(ztz, D):
+    return _parallel_over_atoms(scipy_fftconvolve, ztz, D)
+
+
+def tensordot_parallel(ztz, D):
+    return _parallel_over_atoms(tensordot, ztz, D)
+
+
+def _single_precision(func, ztz, D):
+    """Compute func(ztz, D) in float32, and return the result in float64."""
+    G = func(ztz.astype(np.float32), D.astype(np.float32))
+    return G.astype(np.float64)
+
+
+def numpy_convolve_float32(ztz, D):
+    return _single_precision(numpy_convolve, ztz, D)
+
+
+def scipy_fftconvolve_float32(ztz, D):
+    return _single_precision(scipy_fftconvolve, ztz, D)
+
+
+def tensordot_float32(ztz, D):
+    return _single_precision(tensordot, ztz, D)
 
 
 all_func = [
     numpy_convolve,
-    # scipy_fftconvolve,
+    scipy_fftconvolve,
     dot_and_numba,
-    sum_and_numba,
     tensordot,
+    convolve_ztz_d,
+    numpy_convolve_parallel,
+    scipy_fftconvolve_parallel,
+    tensordot_parallel,
+    numpy_convolve_float32,
+    scipy_fftconvolve_float32,
+    tensordot_float32,
     numpy_convolve_uv,
 ]
 
@@ -148,6 +218,112 @@ try:
 except ImportError:
     pass
 
+try:
+    import pyfftw
+
+    @functools.lru_cache(maxsize=64)
+    def _rfft_plan(shape, n_fft, threads):
+        return pyfftw.builders.rfft(
+            pyfftw.empty_aligned(shape, dtype='float64'), n=n_fft, axis=-1,
+            threads=threads)
+
+    @functools.lru_cache(maxsize=64)
+    def _irfft_plan(shape, n_fft, threads):
+        return pyfftw.builders.irfft(
+            pyfftw.empty_aligned(shape, dtype='complex128'), n=n_fft,
+            axis=-1, threads=threads)
+
+    def pyfftw_fftconvolve(ztz, D):
+        """
+        ztz.shape = n_atoms, n_atoms, 2 * n_times_atom - 1
+        D.shape = n_atoms, n_channels, n_times_atom
+        """
+        n_atoms, n_channels, n_times_atom = D.shape
+        n_fft = next_fast_len(3 * n_times_atom - 2)
+        threads = effective_n_jobs(-1)
+
+        # The plans are cached across calls, and return their internal
+        # output buffer, which is copied before the plan is reused.
+        ztz_fft = _rfft_plan(ztz.shape, n_fft, threads)(ztz).copy()
+        D_fft = _rfft_plan(D.shape, n_fft, threads)(D).copy()
+        G_fft = np.einsum('kKf,Kpf->kpf', ztz_fft, D_fft)
+        G = _irfft_plan(G_fft.shape, n_fft, threads)(G_fft)
+        return G[:, :, n_times_atom - 1:2 * n_times_atom - 1].copy()
+
+    all_func.append(pyfftw_fftconvolve)
+
+except ImportError:
+    pass
+
+try:
+    import cupy
+
+    def cupy_convolve(ztz, D):
+        """
+        ztz.shape = n_atoms, n_atoms, 2 * n_times_atom - 1
+        D.shape = n_atoms, n_channels, n_times_atom
+
+        Device agnostic: computed with cupy on cupy.ndarray inputs, and with
+        numpy otherwise. The result stays on the device of the inputs.
+        """
+        xp = cupy.get_array_module(ztz)
+        n_atoms, n_channels, n_times_atom = D.shape
+        n_rows = n_atoms * n_times_atom
+
+        # same GEMM formulation as tensordot
+        s0, s1, s2 = ztz.strides
+        ztz_windows = xp.lib.stride_tricks.as_strided(
+            ztz, shape=(n_atoms, n_times_atom, n_atoms, n_times_atom),
+            strides=(s0, s2, s1, s2)).reshape(n_rows, n_rows)
+        D = D[:, :, ::-1].transpose(0, 2, 1).reshape(n_rows, n_channels)
+
+        G = xp.matmul(ztz_windows, D)
+        return G.reshape(n_atoms, n_times_atom, n_channels).transpose(0, 2, 1)
+
+    def _has_gpu():
+        try:
+            return cupy.cuda.runtime.getDeviceCount() > 0
+        except cupy.cuda.runtime.CUDARuntimeError:
+            return False
+
+    if _has_gpu():
+        all_func.append(cupy_convolve)
+
+except ImportError:
+    pass
+
+try:
+    import opt_einsum as oe
+
+    _contract_paths = {}
+
+    def opt_einsum_convolve_uv(ztz, uv):
+        """
+        ztz.shape = n_atoms, n_atoms, 2 * n_times_atom - 1
+        uv.shape = n_atoms, n_channels + n_times_atom
+        """
+        assert uv.ndim == 2
+        n_times_atom = (ztz.shape[2] + 1) // 2
+        n_atoms = ztz.shape[0]
+        n_channels = uv.shape[1] - n_times_atom
+
+        u = uv[:, :n_channels]
+        v = uv[:, n_channels:][:, ::-1]
+        ztz_windows = _ztz_windows(ztz, n_times_atom)
+
+        # the contraction path only depends on the shapes, so compute it once
+        key = (n_atoms, n_channels, n_times_atom)
+        if key not in _contract_paths:
+            _contract_paths[key] = oe.contract_path(
+                'kKtu,Ku,Kp->kpt', ztz_windows, v, u, optimize='optimal')[0]
+        return oe.contract('kKtu,Ku,Kp->kpt', ztz_windows, v, u,
+                           optimize=_contract_paths[key])
+
+    all_func.append(opt_einsum_convolve_uv)
+
+except ImportError:
+    pass
+
 try:
     import torch
 
@@ -172,33 +348,57 @@ except ImportError:
 
 def test_equality():
     n_atoms, n_channels, n_times_atom = 5, 10, 15
-    ztz = np.random.randn(n_atoms, n_atoms, 2 * n_times_atom - 1)
-    u = np.random.randn(n_atoms, n_channels)
-    v = np.random.randn(n_atoms, n_times_atom)
+    rng = np.random.RandomState(0)
+    ztz = rng.randn(n_atoms, n_atoms, 2 * n_times_atom - 1)
+    u = rng.randn(n_atoms, n_channels)
+    v = rng.randn(n_atoms, n_times_atom)
     D = u[:, :, None] * v[:, None, :]
+    uv = np.hstack([u, v])
 
     reference = all_func[0](ztz, D)
-    for func in all_func:
+    for func in all_func[1:]:
         if 'uv' in func.__name__:
-            result = func(ztz, uv=np.hstack([u, v]))
+            result = func(ztz, uv=uv)
+        elif 'cupy' in func.__name__:
+            import cupy
+            result = cupy.asnumpy(func(cupy.asarray(ztz), cupy.asarray(D)))
         else:
             result = func(ztz, D=D)
-        assert np.allclose(result, reference)
+        if 'float32' in func.__name__:
+            assert np.allclose(result, reference, rtol=1e-4, atol=1e-4)
+        else:
+            assert np.allclose(result, reference)
 
 
 @memory.cache
 def run_one(n_atoms, n_channels, n_times_atom, func):
-    ztz = np.random.randn(n_atoms, n_atoms, 2 * n_times_atom - 1)
+    rng = np.random.RandomState(0)
+    ztz = rng.randn(n_atoms, n_atoms, 2 * n_times_atom - 1)
 
     if 'uv' in func.__name__:
-        uv = np.random.randn(n_atoms, n_channels + n_times_atom)
+        uv = rng.randn(n_atoms, n_channels + n_times_atom)
         D = uv
     else:
-        D = np.random.randn(n_atoms, n_channels, n_times_atom)
+        D = rng.randn(n_atoms, n_channels, n_times_atom)
+
+    if 'cupy' in func.__name__:
+        # move the inputs to the GPU once, to exclude the transfers from
+        # the timing, and wait for the asynchronous kernels to finish
+        import cupy
+        ztz, D = cupy.asarray(ztz), cupy.asarray(D)
+        synchronize = cupy.cuda.get_current_stream().synchronize
+    else:
+        def synchronize():
+            pass
+
+    # warm up, to exclude numba compilation and FFT planning from the timing
+    func(ztz, D)
+    synchronize()
 
-    start = time.time()
+    start = time.perf_counter()
     func(ztz, D)
-    duration = time.time() - start
+    synchronize()
+    duration = time.perf_counter() - start
     return (n_atoms, n_channels, n_times_atom, func.__name__, duration)
 
 